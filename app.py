@@ -1,7 +1,10 @@
 import streamlit as st
-from supabase import create_client
-from google import genai
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
 import os
+from typing import Iterator, Optional
 
 # Page config
 st.set_page_config(
@@ -11,81 +14,128 @@ st.set_page_config(
 )
 
 # Custom CSS
-st.markdown("""
-<style>
-    .file-card {
-        padding: 10px;
-        border-radius: 8px;
-        margin-bottom: 8px;
-        cursor: pointer;
-    }
-    .file-card:hover {
-        background-color: #f0f2f6;
-    }
-    .summary-container {
-        background-color: #f8f9fa;
-        padding: 20px;
-        border-radius: 10px;
-        border-left: 4px solid #4CAF50;
-    }
-    .search-result {
-        background-color: #ffffff;
-        padding: 15px;
-        border-radius: 8px;
-        border: 1px solid #e0e0e0;
-        margin-bottom: 10px;
-    }
-    .similarity-badge {
-        background-color: #e3f2fd;
-        padding: 2px 8px;
-        border-radius: 12px;
-        font-size: 12px;
-    }
-</style>
-""", unsafe_allow_html=True)
+@st.cache_data(show_spinner=False)
+def load_css() -> str:
+    with open(os.path.join(os.path.dirname(__file__), "static", "styles.css")) as f:
+        return f.read()
+
+st.html(f"<style>{load_css()}</style>")
 
 # Initialize clients
 @st.cache_resource
 def init_clients():
+    # Imported here so their import cost is paid once, on first use
+    import httpx
+    from google import genai
+    from google.genai import types
+    from supabase import ClientOptions, create_client
+
+    # One keep-alive HTTP/2 pool shared by both clients, so calls across
+    # reruns reuse sockets instead of paying a TLS handshake each time
+    http_client = httpx.Client(
+        transport=httpx.HTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60.0),
+        ),
+        timeout=httpx.Timeout(120.0),
+    )
     supabase = create_client(
         os.environ.get("SUPABASE_URL", st.secrets.get("SUPABASE_URL", "")),
-        os.environ.get("SUPABASE_SERVICE_KEY", st.secrets.get("SUPABASE_SERVICE_KEY", ""))
+        os.environ.get("SUPABASE_SERVICE_KEY", st.secrets.get("SUPABASE_SERVICE_KEY", "")),
+        options=ClientOptions(httpx_client=http_client),
     )
     ai = genai.Client(
-        api_key=os.environ.get("GEMINI_API_KEY", st.secrets.get("GEMINI_API_KEY", ""))
+        api_key=os.environ.get("GEMINI_API_KEY", st.secrets.get("GEMINI_API_KEY", "")),
+        http_options=types.HttpOptions(httpx_client=http_client),
     )
     return supabase, ai
 
 supabase, ai = init_clients()
 
 # Helper functions
+def parse_vector(value) -> list:
+    # pgvector columns come back from PostgREST as a string like "[0.1,0.2,...]"
+    return json.loads(value) if isinstance(value, str) else value
+
+@st.cache_data(max_entries=2048, show_spinner=False)
 def generate_embedding(text: str) -> list:
+    # Check the persistent cache before calling Gemini
+    text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    cached = supabase.from_("query_embedding_cache").select("vector").eq("hash", text_hash).execute()
+    if cached.data:
+        return parse_vector(cached.data[0]["vector"])
+
     response = ai.models.embed_content(
         model="text-embedding-004",
         contents=text,
     )
-    return response.embeddings[0].values
+    vector = response.embeddings[0].values
+    supabase.from_("query_embedding_cache").upsert({"hash": text_hash, "vector": vector}).execute()
+    return vector
 
-def search_transcripts(query: str, match_count: int = 5) -> list:
+def search_transcripts(query: str, match_count: int = 5, include_embedding: bool = False) -> list:
     query_vector = generate_embedding(query)
     result = supabase.rpc("search_transcripts", {
         "query_embedding": query_vector,
         "match_threshold": 0.3,
         "match_count": match_count,
+        "include_embedding": include_embedding,
     }).execute()
     return result.data or []
 
-def generate_search_insights(query: str, results: list) -> str:
+def rerank_results(results: list, count: int = 5, mmr_lambda: float = 0.7) -> list:
+    # Drop exact duplicate chunks (e.g. a file ingested twice)
+    seen = set()
+    unique = []
+    for r in results:
+        key = (r["source_file"], r["content"][:200])
+        if key not in seen:
+            seen.add(key)
+            unique.append(r)
+    if len(unique) <= count:
+        return unique
+
+    # Imported here: only needed when there are more chunks than slots
+    import numpy as np
+
+    # Maximal Marginal Relevance: trade relevance against redundancy with already picked chunks
+    vectors = np.array([parse_vector(r["embedding"]) for r in unique], dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    pairwise = vectors @ vectors.T
+    relevance = np.array([r["similarity"] for r in unique])
+
+    selected = [int(np.argmax(relevance))]
+    while len(selected) < count:
+        redundancy = pairwise[:, selected].max(axis=1)
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+        scores[selected] = -np.inf
+        selected.append(int(np.argmax(scores)))
+    return [unique[i] for i in selected]
+
+SEARCH_CACHE_TTL = timedelta(hours=24)
+
+def get_cached_insights(query: str, match_count: int) -> Optional[str]:
+    # Answer to a semantically equivalent earlier question, if still fresh.
+    # The query embedding is already in generate_embedding's cache.
+    cached = supabase.rpc("match_cached_answer", {
+        "query_embedding": generate_embedding(query),
+        "match_count": match_count,
+        "match_threshold": 0.92,
+        "min_created_at": (datetime.now(timezone.utc) - SEARCH_CACHE_TTL).isoformat(),
+    }).execute()
+    return cached.data or None
+
+def generate_search_insights(query: str, results: list, match_count: int) -> Iterator[str]:
     if not results:
-        return ""
+        return
 
     # Combine relevant content
-    context = "\n\n---\n\n".join([
+    context = "\n\n---\n\n".join(
         f"From '{r['source_file']}':\n{r['content']}"
-        for r in results[:5]
-    ])
+        for r in rerank_results(results)
+    )
 
-    response = ai.models.generate_content(
+    stream = ai.models.generate_content_stream(
         model="gemini-2.5-flash",
         contents=f"""Based on the user's question and the relevant audio transcript segments below, provide a helpful AI-generated answer.
 
@@ -103,35 +153,104 @@ def generate_search_insights(query: str, results: list) -> str:
 
 Provide your response in markdown format."""
     )
-    return response.text
-
+    parts = []
+    for chunk in stream:
+        if chunk.text:
+            parts.append(chunk.text)
+            yield chunk.text
+
+    answer = "".join(parts)
+    if answer:
+        supabase.from_("search_cache").insert({
+            "embedding": generate_embedding(query),
+            "match_count": match_count,
+            "response": answer,
+        }).execute()
+        # Drop expired answers so the table does not grow unbounded
+        cutoff = datetime.now(timezone.utc) - SEARCH_CACHE_TTL
+        supabase.from_("search_cache").delete().lt("created_at", cutoff.isoformat()).execute()
+
+@st.cache_data(ttl=300, show_spinner=False)
 def get_all_files() -> list:
-    result = supabase.from_("transcripts").select("source_file, created_at").execute()
-    if not result.data:
-        return []
-
-    file_map = {}
-    for row in result.data:
-        if row["source_file"] not in file_map:
-            file_map[row["source_file"]] = {"count": 0, "date": row["created_at"]}
-        file_map[row["source_file"]]["count"] += 1
-
-    return [{"name": k, "chunks": v["count"], "date": v["date"]} for k, v in file_map.items()]
+    # Aggregated server-side: one row per file instead of one per chunk
+    result = supabase.rpc("get_file_index").execute()
+    return result.data or []
 
+@st.cache_data(ttl=300, show_spinner=False)
 def get_full_transcript(source_file: str) -> str:
-    result = supabase.from_("transcripts").select("content").eq("source_file", source_file).order("created_at").execute()
-    if not result.data:
-        return ""
-    return " ".join([r["content"] for r in result.data])
+    # Chunks are concatenated in Postgres so only one row comes back
+    result = supabase.rpc("get_transcript", {"src": source_file}).execute()
+    return result.data or ""
 
-def summarize_transcript(source_file: str) -> str:
-    transcript = get_full_transcript(source_file)
-    if not transcript:
-        return "No transcript found."
+SUMMARY_BATCH_SIZE = 8
 
+def summarize_section(text: str) -> str:
     response = ai.models.generate_content(
         model="gemini-2.5-flash",
-        contents=f"""Please provide a comprehensive summary of the following transcript in markdown format.
+        contents=f"""Summarize this section of a transcript concisely. Keep the main topics, key points, conclusions, and any mentioned next steps.
+
+Transcript section:
+{text}"""
+    )
+    return response.text or ""
+
+def summarize_batches(batches: list) -> list:
+    # Partial summaries are stored under each batch's first chunk id, together with
+    # a hash of all its chunk ids so a batch that gained chunks is summarized again
+    keys = [batch[0]["id"] for batch in batches]
+    hashes = {
+        batch[0]["id"]: hashlib.sha256(",".join(r["id"] for r in batch).encode("utf-8")).hexdigest()
+        for batch in batches
+    }
+    cached = supabase.from_("chunk_summaries").select("chunk_id, batch_hash, content").in_("chunk_id", keys).execute()
+    summaries = {
+        r["chunk_id"]: r["content"]
+        for r in cached.data or []
+        if r["content"] and r["batch_hash"] == hashes[r["chunk_id"]]
+    }
+
+    missing = [batch for batch in batches if batch[0]["id"] not in summaries]
+    if missing:
+        with st.spinner(f"Summarizing {len(missing)} sections of the transcript..."):
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                texts = executor.map(summarize_section, (" ".join(r["content"] for r in batch) for batch in missing))
+                generated = {batch[0]["id"]: text for batch, text in zip(missing, texts)}
+        # Empty partials (e.g. a blocked response) are not stored, so the next run retries them
+        stored = [
+            {"chunk_id": chunk_id, "batch_hash": hashes[chunk_id], "content": content}
+            for chunk_id, content in generated.items()
+            if content
+        ]
+        if stored:
+            supabase.from_("chunk_summaries").upsert(stored).execute()
+        summaries.update(generated)
+
+    return [summaries[k] for k in keys]
+
+def summarize_transcript(source_file: str) -> Iterator[str]:
+    cached = supabase.from_("summaries").select("content").eq("source_file", source_file).execute()
+    # An empty stored summary (saved by older versions) is treated as missing
+    if cached.data and cached.data[0]["content"]:
+        yield cached.data[0]["content"]
+        return
+
+    result = supabase.from_("transcripts").select("id, content").eq("source_file", source_file).order("created_at").execute()
+    if not result.data:
+        yield "No transcript found."
+        return
+
+    # Map-reduce for long transcripts: summarize batches of chunks, then combine
+    batches = [result.data[i:i + SUMMARY_BATCH_SIZE] for i in range(0, len(result.data), SUMMARY_BATCH_SIZE)]
+    if len(batches) == 1:
+        source = "the following transcript"
+        material = "Transcript:\n" + " ".join(r["content"] for r in result.data)
+    else:
+        source = "a transcript, given below as summaries of its consecutive sections"
+        material = "Section summaries:\n" + "\n\n---\n\n".join(summarize_batches(batches))
+
+    stream = ai.models.generate_content_stream(
+        model="gemini-2.5-flash",
+        contents=f"""Please provide a comprehensive summary of {source} in markdown format.
 
 Structure it with:
 ## Overview
@@ -146,10 +265,26 @@ A brief 2-3 sentence overview
 ## Action Items (if any)
 - Any mentioned next steps or recommendations
 
-Transcript:
-{transcript}"""
+{material}"""
     )
-    return response.text
+    parts = []
+    for chunk in stream:
+        if chunk.text:
+            parts.append(chunk.text)
+            yield chunk.text
+
+    summary = "".join(parts)
+    if summary:
+        supabase.from_("summaries").upsert({
+            "source_file": source_file,
+            "content": summary,
+            "generated_at": datetime.now(timezone.utc).isoformat(),
+        }).execute()
+
+@st.cache_data(show_spinner=False)
+def get_display_names(names: tuple) -> dict:
+    # Truncated labels for long file names, shared by the sidebar and quick links
+    return {n: n[:22] + "..." if len(n) > 25 else n for n in names}
 
 # Initialize session state
 if "active_view" not in st.session_state:
@@ -159,8 +294,37 @@ if "selected_file" not in st.session_state:
 if "current_summary" not in st.session_state:
     st.session_state.current_summary = None
 
+# Widget callbacks: state changes run before the rerun that follows the click
+def select_file(name: str):
+    st.session_state.selected_file = name
+    st.session_state.file_choice = name
+    st.session_state.active_view = "file_detail"
+    st.session_state.current_summary = None
+
+def show_search():
+    st.session_state.active_view = "search"
+    st.session_state.selected_file = None
+    st.session_state.file_choice = None
+
+def refresh_files():
+    get_all_files.clear()
+    get_full_transcript.clear()
+
+def regenerate_summary(source_file: str):
+    # Drop the stored summary and its section partials (stored under each
+    # batch's first chunk), then let the rerun generate a new one
+    result = supabase.from_("transcripts").select("id").eq("source_file", source_file).order("created_at").execute()
+    batch_keys = [r["id"] for r in (result.data or [])[::SUMMARY_BATCH_SIZE]]
+    if batch_keys:
+        supabase.from_("chunk_summaries").delete().in_("chunk_id", batch_keys).execute()
+    supabase.from_("summaries").delete().eq("source_file", source_file).execute()
+    st.session_state.current_summary = None
+    st.session_state.summary_requested = True
+
 # Get files
 files = get_all_files()
+files_by_name = {f["name"]: f for f in files}
+display_names = get_display_names(tuple(files_by_name))
 
 # Sidebar - File list
 with st.sidebar:
@@ -172,26 +336,27 @@ with st.sidebar:
     # Navigation
     st.subheader("📁 Your Audio Files")
 
+    st.button("🔄 Refresh", on_click=refresh_files, use_container_width=True)
+
     if files:
-        for f in files:
-            col1, col2 = st.columns([3, 1])
-            with col1:
-                display_name = f["name"][:25] + "..." if len(f["name"]) > 25 else f["name"]
-                if st.button(f"🎵 {display_name}", key=f"file_{f['name']}", use_container_width=True):
-                    st.session_state.selected_file = f["name"]
-                    st.session_state.active_view = "file_detail"
-                    st.session_state.current_summary = None
-            with col2:
-                st.caption(f"{f['chunks']} chunks")
+        # A single widget regardless of how many files there are
+        st.selectbox(
+            "Audio files",
+            options=list(files_by_name),
+            index=None,
+            key="file_choice",
+            on_change=lambda: select_file(st.session_state.file_choice),
+            format_func=lambda n: f"🎵 {display_names[n]}  ({files_by_name[n]['chunks']} chunks)",
+            placeholder="Select an audio file",
+            label_visibility="collapsed",
+        )
     else:
         st.info("No audio files yet")
 
     st.divider()
 
     # Quick actions
-    if st.button("🔍 Search", use_container_width=True):
-        st.session_state.active_view = "search"
-        st.session_state.selected_file = None
+    st.button("🔍 Search", on_click=show_search, use_container_width=True)
 
 # Main content
 if st.session_state.active_view == "search":
@@ -201,28 +366,35 @@ if st.session_state.active_view == "search":
     # Search input
     col1, col2 = st.columns([4, 1])
     with col1:
-        query = st.text_input("", placeholder="What was discussed about AI evaluation?", label_visibility="collapsed")
+        query = st.text_input("", key="query", placeholder="What was discussed about AI evaluation?", label_visibility="collapsed")
     with col2:
         num_results = st.selectbox("Results", [5, 10, 15, 20], label_visibility="collapsed")
 
     if query:
         with st.spinner("Searching your audio files..."):
-            results = search_transcripts(query, num_results)
+            # Embed once up front; the search and the cached answer lookup both
+            # only need the embedding, so their RPCs run concurrently
+            generate_embedding(query)
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                # rerank_results only uses embeddings when there are more than 5 results to pick from
+                results_future = executor.submit(search_transcripts, query, num_results, num_results > 5)
+                cached_future = executor.submit(get_cached_insights, query, num_results)
+                results = results_future.result()
+                cached_insights = cached_future.result()
 
         if results:
             # AI Insights section
             st.markdown("### 🤖 AI Answer")
-            with st.spinner("Generating insights..."):
-                insights = generate_search_insights(query, results)
-
-            st.markdown(f"""
-            <div class="summary-container">
-            {insights}
-            </div>
-            """, unsafe_allow_html=True)
+            if cached_insights:
+                st.markdown(cached_insights)
+            else:
+                st.write_stream(generate_search_insights(query, results, num_results))
 
             st.markdown(f"### 📚 Source Segments ({len(results)} found)")
-            st.caption("These are the transcript segments used to generate the answer above")
+            if cached_insights:
+                st.caption("The answer above was reused from an earlier, similar question. These are the segments matching your question now")
+            else:
+                st.caption("These are the transcript segments used to generate the answer above")
 
             for i, r in enumerate(results):
                 with st.expander(f"📄 {r['source_file']} — {r['similarity']:.0%} match"):
@@ -236,10 +408,13 @@ if st.session_state.active_view == "search":
             cols = st.columns(min(3, len(files)))
             for i, f in enumerate(files[:3]):
                 with cols[i]:
-                    if st.button(f"📂 {f['name'][:20]}...", key=f"quick_{f['name']}", use_container_width=True):
-                        st.session_state.selected_file = f["name"]
-                        st.session_state.active_view = "file_detail"
-                        st.rerun()
+                    st.button(
+                        f"📂 {display_names[f['name']]}",
+                        key=f"quick_{f['name']}",
+                        on_click=select_file,
+                        args=(f["name"],),
+                        use_container_width=True,
+                    )
 
 elif st.session_state.active_view == "file_detail" and st.session_state.selected_file:
     selected = st.session_state.selected_file
@@ -248,7 +423,7 @@ elif st.session_state.active_view == "file_detail" and st.session_state.selected
     st.title(f"🎵 {selected}")
 
     # File info
-    file_info = next((f for f in files if f["name"] == selected), None)
+    file_info = files_by_name.get(selected)
     if file_info:
         col1, col2, col3 = st.columns(3)
         with col1:
@@ -256,8 +431,7 @@ elif st.session_state.active_view == "file_detail" and st.session_state.selected
         with col2:
             st.metric("Added", file_info["date"][:10])
         with col3:
-            chars = len(get_full_transcript(selected))
-            st.metric("Characters", f"{chars:,}")
+            st.metric("Characters", f"{file_info['char_count']:,}")
 
     st.divider()
 
@@ -265,15 +439,16 @@ elif st.session_state.active_view == "file_detail" and st.session_state.selected
     tab1, tab2 = st.tabs(["📝 Summary", "📄 Full Transcript"])
 
     with tab1:
-        if st.button("✨ Generate AI Summary", type="primary", use_container_width=True):
-            with st.spinner("Generating summary with Gemini..."):
-                st.session_state.current_summary = summarize_transcript(selected)
-
-        if st.session_state.current_summary:
+        generate = st.button("✨ Generate AI Summary", type="primary", use_container_width=True)
+        if generate or st.session_state.pop("summary_requested", False):
+            # Render tokens as they arrive; write_stream returns the full text
+            st.session_state.current_summary = st.write_stream(summarize_transcript(selected))
+        elif st.session_state.current_summary:
             st.markdown('<div class="summary-container">', unsafe_allow_html=True)
             st.markdown(st.session_state.current_summary)
             st.markdown('</div>', unsafe_allow_html=True)
 
+        if st.session_state.current_summary:
             # Download button
             st.download_button(
                 "📥 Download Summary",
@@ -281,6 +456,7 @@ elif st.session_state.active_view == "file_detail" and st.session_state.selected
                 file_name=f"{selected}_summary.md",
                 mime="text/markdown"
             )
+            st.button("🔄 Regenerate Summary", on_click=regenerate_summary, args=(selected,), use_container_width=True)
         else:
             st.info("Click the button above to generate an AI-powered summary of this audio file.")
 
@@ -14,12 +14,18 @@ const CHUNK_SIZE = 1000;
 const CHUNK_OVERLAP = 200;
 
 interface TranscriptDocument {
-  id: string;
   content: string;
   source_file: string;
   similarity: number;
 }
 
+interface FileIndexEntry {
+  name: string;
+  chunks: number;
+  date: string;
+  char_count: number;
+}
+
 // Validate required environment variables
 const requiredEnvVars = ["SUPABASE_URL", "SUPABASE_SERVICE_KEY", "GEMINI_API_KEY"];
 for (const envVar of requiredEnvVars) {
@@ -370,10 +376,8 @@ server.tool(
   {},
   async () => {
     try {
-      const { data, error } = await supabase
-        .from("transcripts")
-        .select("source_file, created_at")
-        .order("created_at", { ascending: false });
+      // Files are grouped and counted in Postgres by the get_file_index RPC
+      const { data, error } = await supabase.rpc("get_file_index");
 
       if (error) {
         return {
@@ -388,21 +392,11 @@ server.tool(
         };
       }
 
-      // Group by source_file and count chunks
-      const fileMap = new Map<string, { count: number; earliestDate: string }>();
-      for (const row of data) {
-        const existing = fileMap.get(row.source_file);
-        if (existing) {
-          existing.count++;
-        } else {
-          fileMap.set(row.source_file, { count: 1, earliestDate: row.created_at });
-        }
-      }
-
-      const lines: string[] = [`Found ${fileMap.size} transcribed audio file(s):\n`];
-      for (const [fileName, info] of fileMap) {
-        const date = new Date(info.earliestDate).toLocaleDateString();
-        lines.push(`- ${fileName} (${info.count} chunks, added ${date})`);
+      const files = data as FileIndexEntry[];
+      const lines: string[] = [`Found ${files.length} transcribed audio file(s):\n`];
+      for (const file of files) {
+        const date = new Date(file.date).toLocaleDateString();
+        lines.push(`- ${file.name} (${file.chunks} chunks, ${file.char_count} characters, added ${date})`);
       }
 
       return {
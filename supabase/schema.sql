@@ -1,4 +1,4 @@
--- Enable the pgvector extension
+-- Enable the pgvector extension (0.7+ for halfvec)
 create extension if not exists vector;
 
 -- Create the transcripts table
@@ -6,40 +6,227 @@ create table if not exists transcripts (
   id uuid primary key default gen_random_uuid(),
   content text not null,
   source_file text not null,
-  embedding vector(768), -- Gemini text-embedding-004 outputs 768 dimensions
+  embedding halfvec(768), -- Gemini text-embedding-004 outputs 768 dimensions, stored as fp16
   created_at timestamp with time zone default now()
 );
 
+-- Migrate existing fp32 embeddings to halfvec (halves row and index size)
+do $$
+begin
+  if exists (
+    select 1 from information_schema.columns
+    where table_name = 'transcripts' and column_name = 'embedding' and udt_name = 'vector'
+  ) then
+    drop index if exists transcripts_embedding_idx;
+    alter table transcripts
+      alter column embedding type halfvec(768) using embedding::halfvec(768);
+  end if;
+end;
+$$;
+
 -- Create an index for faster vector similarity search
 create index if not exists transcripts_embedding_idx
   on transcripts
-  using ivfflat (embedding vector_cosine_ops)
-  with (lists = 100);
+  using hnsw (embedding halfvec_cosine_ops);
+
+-- Refresh planner statistics so the index is used
+analyze transcripts;
 
 -- Create the search function
+-- (dropped first because create or replace cannot change the return columns)
+drop function if exists search_transcripts(vector, float, int);
+drop function if exists search_transcripts(halfvec, float, int);
 create or replace function search_transcripts(
-  query_embedding vector(768),
+  query_embedding halfvec(768),
   match_threshold float default 0.7,
-  match_count int default 5
+  match_count int default 5,
+  include_embedding boolean default false
 )
 returns table (
-  id uuid,
-  content text,
   source_file text,
-  similarity float
+  content text,
+  similarity float,
+  embedding halfvec(768)
 )
 language plpgsql
 as $$
 begin
   return query
   select
-    t.id,
-    t.content,
     t.source_file,
-    1 - (t.embedding <=> query_embedding) as similarity
+    t.content,
+    1 - (t.embedding <=> query_embedding) as similarity,
+    -- Only returned on request (for re-ranking); it is 768 numbers per row
+    case when include_embedding then t.embedding end
   from transcripts t
   where 1 - (t.embedding <=> query_embedding) > match_threshold
   order by t.embedding <=> query_embedding
   limit match_count;
 end;
 $$;
+
+-- Cache of query embeddings, keyed by sha256 of the query text
+create table if not exists query_embedding_cache (
+  hash text primary key,
+  vector vector(768),
+  created_at timestamp with time zone default now()
+);
+
+-- Index for per-file lookups and aggregation, and to read a file's chunks in order
+-- (its source_file prefix replaces the former single-column index)
+drop index if exists transcripts_source_file_idx;
+create index if not exists transcripts_source_file_created_at_idx
+  on transcripts (source_file, created_at);
+
+-- Per-file metadata, kept up to date by a trigger on transcripts
+create table if not exists files (
+  source_file text primary key,
+  char_count bigint not null default 0,
+  created_at timestamp with time zone default now()
+);
+
+-- Backfill files ingested before the table existed
+insert into files (source_file, char_count)
+select t.source_file, sum(length(t.content))
+from transcripts t
+group by t.source_file
+on conflict (source_file) do nothing;
+
+-- Keeps files.char_count current and drops the file's stored summary, which
+-- no longer matches once chunks are appended (re-ingest) or deleted
+drop trigger if exists transcripts_file_char_count on transcripts;
+drop function if exists update_file_char_count();
+create or replace function sync_file_metadata()
+returns trigger
+language plpgsql
+as $$
+begin
+  if tg_op = 'INSERT' then
+    insert into files (source_file, char_count)
+    values (new.source_file, length(new.content))
+    on conflict (source_file)
+    do update set char_count = files.char_count + excluded.char_count;
+    delete from summaries where source_file = new.source_file;
+    return new;
+  end if;
+
+  update files
+  set char_count = char_count - length(old.content)
+  where source_file = old.source_file;
+  delete from summaries where source_file = old.source_file;
+  return old;
+end;
+$$;
+
+drop trigger if exists transcripts_sync_file_metadata on transcripts;
+create trigger transcripts_sync_file_metadata
+  after insert or delete on transcripts
+  for each row execute function sync_file_metadata();
+
+-- List files with their chunk count, date added and character count
+-- (dropped first because create or replace cannot change the return columns)
+drop function if exists get_file_index();
+create or replace function get_file_index()
+returns table (
+  name text,
+  chunks bigint,
+  date timestamp with time zone,
+  char_count bigint
+)
+language sql
+as $$
+  select
+    t.source_file as name,
+    count(*) as chunks,
+    min(t.created_at) as date,
+    -- Chunks are joined with single spaces, so count those too to match the
+    -- length of the full transcript (get_transcript / get_full_transcript)
+    coalesce(f.char_count, 0) + count(*) - 1 as char_count
+  from transcripts t
+  left join files f on f.source_file = t.source_file
+  group by t.source_file, f.char_count
+  order by min(t.created_at) desc;
+$$;
+
+-- Get the full transcript of a file as a single string
+create or replace function get_transcript(src text)
+returns text
+language sql
+as $$
+  select string_agg(t.content, ' ' order by t.created_at)
+  from transcripts t
+  where t.source_file = src;
+$$;
+
+-- Cache of AI answers to search queries, matched by query similarity
+create table if not exists search_cache (
+  id uuid primary key default gen_random_uuid(),
+  embedding vector(768),
+  match_count int not null default 5,
+  response text not null,
+  created_at timestamp with time zone default now()
+);
+
+alter table search_cache add column if not exists match_count int not null default 5;
+
+-- HNSW rather than ivfflat: ivfflat centroids would be trained on the
+-- empty table at creation time and miss near-duplicate queries
+drop index if exists search_cache_embedding_idx;
+create index if not exists search_cache_embedding_hnsw_idx
+  on search_cache
+  using hnsw (embedding vector_cosine_ops);
+
+-- Cached answers are stale as soon as transcripts are ingested or deleted
+create or replace function clear_search_cache()
+returns trigger
+language plpgsql
+as $$
+begin
+  delete from search_cache;
+  return null;
+end;
+$$;
+
+drop trigger if exists transcripts_clear_search_cache on transcripts;
+create trigger transcripts_clear_search_cache
+  after insert or delete on transcripts
+  for each statement execute function clear_search_cache();
+
+-- Find a fresh cached answer for a semantically equivalent query
+drop function if exists match_cached_answer(vector, float);
+create or replace function match_cached_answer(
+  query_embedding vector(768),
+  match_count int,
+  match_threshold float default 0.92,
+  min_created_at timestamp with time zone default now() - interval '1 day'
+)
+returns text
+language sql
+as $$
+  select c.response
+  from search_cache c
+  where c.match_count = match_cached_answer.match_count
+    and c.created_at >= min_created_at
+    and 1 - (c.embedding <=> query_embedding) > match_threshold
+  order by c.embedding <=> query_embedding
+  limit 1;
+$$;
+
+-- Partial summaries of transcript sections, keyed by the section's first chunk.
+-- batch_hash covers every chunk id in the section, so a section that gained
+-- chunks on re-ingest no longer matches its stored summary.
+create table if not exists chunk_summaries (
+  chunk_id uuid primary key references transcripts (id) on delete cascade,
+  batch_hash text,
+  content text not null,
+  created_at timestamp with time zone default now()
+);
+
+alter table chunk_summaries add column if not exists batch_hash text;
+
+-- Generated summaries, one per audio file
+create table if not exists summaries (
+  source_file text primary key,
+  content text not null,
+  generated_at timestamp with time zone default now()
+);